@@ -1,8 +1,10 @@
 # agents/codegen_agent.py
 
+import contextvars
 import json
 import os
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from anthropic import Anthropic
 from dotenv import load_dotenv
@@ -15,26 +17,106 @@ FILE_BLOCK_RE = re.compile(
     re.DOTALL
 )
 
+MANIFEST_TOOL_NAME = "submit_file_manifest"
+
+MANIFEST_TOOL_SCHEMA = {
+    "type": "object",
+    "required": ["files"],
+    "properties": {
+        "files": {
+            "type": "array",
+            "minItems": 1,
+            "items": {
+                "type": "object",
+                "required": ["path", "purpose"],
+                "properties": {
+                    "path": {"type": "string", "minLength": 1},
+                    "purpose": {"type": "string", "minLength": 1}
+                }
+            }
+        }
+    }
+}
+
+
+def build_prompt(planner_output: dict | str, **fields) -> str:
+    """
+    Serializes {"planner_output": ..., **fields} for a user message.
+    planner_output may already be serialized JSON text, so callers
+    generating many units from one plan only serialize it once.
+    """
+    if not isinstance(planner_output, str):
+        return json.dumps({"planner_output": planner_output, **fields})
+    if not fields:
+        return '{"planner_output": ' + planner_output + "}"
+    return '{"planner_output": ' + planner_output + ", " + json.dumps(fields)[1:]
+
+
+def count_loc(path: Path, relative_paths=None) -> int:
+    """
+    Number of non-blank lines across every file under path, or only
+    across relative_paths under it when given (e.g. the files one
+    generation call wrote, ignoring leftovers from an earlier run).
+    """
+    if relative_paths is None:
+        if not path.exists():
+            return 0
+        file_paths = path.rglob("*")
+    else:
+        file_paths = (path / relative_path for relative_path in set(relative_paths))
+    loc = 0
+    for file_path in file_paths:
+        if file_path.is_file():
+            text = file_path.read_text(errors="ignore")
+            loc += sum(1 for line in text.splitlines() if line.strip())
+    return loc
+
 
 class CodeGenAgent:
-    def __init__(self, system_prompt_path: str):
+    def __init__(
+        self,
+        system_prompt_path: str,
+        usage_callback=None,
+        manifest_prompt_path: str = "prompts/manifest.system.txt"
+    ):
         api_key = os.getenv("ANTHROPIC_API_KEY")
         if not api_key:
             raise RuntimeError("ANTHROPIC_API_KEY missing in environment")
 
         self.client = Anthropic(api_key=api_key)
         self.system_prompt = Path(system_prompt_path).read_text(encoding="utf-8")
+        self.manifest_prompt_path = manifest_prompt_path
+        # Optional hook called with (model, usage) after every API call
+        self.usage_callback = usage_callback
+
+    def _write_file_blocks(self, raw_text: str, output_path: Path) -> list[str]:
+        matches = FILE_BLOCK_RE.findall(raw_text)
+
+        if not matches:
+            raise RuntimeError(
+                "CodeGen output contained no file blocks. "
+                "This violates the CodeGen contract."
+            )
+
+        for relative_path, content in matches:
+            file_path = output_path / relative_path
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            file_path.write_text(content)
+
+        # Normalized so "./app.py" and "app.py" compare equal
+        return [Path(relative_path).as_posix() for relative_path, _ in matches]
 
     def generate_unit(
         self,
-        planner_output: dict,
+        planner_output: dict | str,
         unit_description: str,
         output_path: Path
-    ):
-        prompt = {
-            "planner_output": planner_output,
-            "unit_to_generate": unit_description
-        }
+    ) -> list[str]:
+        """Writes the unit in one call; returns the relative paths written."""
+        prompt = build_prompt(
+            planner_output,
+            unit_to_generate=unit_description
+        )
 
         response = self.client.messages.create(
             model="claude-3-5-haiku-20241022",
@@ -44,24 +126,172 @@ class CodeGenAgent:
             messages=[
                 {
                     "role": "user",
-                    "content": json.dumps(prompt)
+                    "content": prompt
                 }
             ]
         )
 
+        if self.usage_callback is not None:
+            self.usage_callback(response.model, response.usage)
+
         raw_text = response.content[0].text
 
-        matches = FILE_BLOCK_RE.findall(raw_text)
+        return self._write_file_blocks(raw_text, output_path)
 
-        if not matches:
-            raise RuntimeError(
-                "CodeGen output contained no file blocks. "
-                "This violates the CodeGen contract."
+    # -----------------------------
+    # Hierarchical generation
+    # -----------------------------
+
+    def generate_manifest(
+        self,
+        planner_output: dict | str,
+        unit_description: str,
+        target_loc: int
+    ) -> list[dict]:
+        """
+        First level: one fast call listing the unit's files as
+        [{"path": ..., "purpose": ...}], submitted through a forced tool call.
+        """
+        prompt = build_prompt(
+            planner_output,
+            unit_to_generate=unit_description,
+            target_loc=target_loc
+        )
+
+        response = self.client.messages.create(
+            model="claude-3-5-haiku-20241022",
+            max_tokens=4000,
+            temperature=0.4,
+            system=Path(self.manifest_prompt_path).read_text(encoding="utf-8"),
+            tools=[
+                {
+                    "name": MANIFEST_TOOL_NAME,
+                    "description": "Submit the file manifest for the unit.",
+                    "input_schema": MANIFEST_TOOL_SCHEMA
+                }
+            ],
+            tool_choice={"type": "tool", "name": MANIFEST_TOOL_NAME},
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ]
+        )
+
+        if self.usage_callback is not None:
+            self.usage_callback(response.model, response.usage)
+
+        for block in response.content:
+            if block.type == "tool_use" and block.name == MANIFEST_TOOL_NAME:
+                files = block.input.get("files") if isinstance(block.input, dict) else None
+                manifest = [
+                    {"path": str(f["path"]), "purpose": str(f.get("purpose", ""))}
+                    for f in files or []
+                    if isinstance(f, dict) and f.get("path")
+                ]
+                if manifest:
+                    return manifest
+                break
+
+        raise RuntimeError(
+            "CodeGen manifest call returned no file manifest. "
+            "This violates the CodeGen contract."
+        )
+
+    def generate_files(
+        self,
+        planner_output: dict | str,
+        unit_description: str,
+        manifest: list[dict],
+        files_to_generate: list[dict],
+        output_path: Path
+    ) -> list[str]:
+        """
+        Second level: writes one slice of the manifest. The whole manifest
+        is shared as context so cross-file references line up.
+        """
+        prompt = build_prompt(
+            planner_output,
+            unit_to_generate=unit_description,
+            file_manifest=manifest,
+            files_to_generate=files_to_generate,
+            instructions=(
+                "Output ONLY the files listed in files_to_generate, at exactly "
+                "those paths. Other manifest files are written separately; "
+                "import and call them as their purpose describes."
             )
+        )
 
-        for relative_path, content in matches:
-            file_path = output_path / relative_path
-            file_path.parent.mkdir(parents=True, exist_ok=True)
-            file_path.write_text(content)
+        response = self.client.messages.create(
+            model="claude-3-5-haiku-20241022",
+            max_tokens=8000,
+            temperature=0.4,
+            system=self.system_prompt,
+            messages=[
+                {
+                    "role": "user",
+                    "content": prompt
+                }
+            ]
+        )
+
+        if self.usage_callback is not None:
+            self.usage_callback(response.model, response.usage)
 
-        return len(matches)
+        return self._write_file_blocks(response.content[0].text, output_path)
+
+    def generate_unit_hierarchical(
+        self,
+        planner_output: dict | str,
+        unit_description: str,
+        output_path: Path,
+        target_loc: int,
+        files_per_call: int = 2,
+        max_workers: int = 4
+    ) -> dict:
+        """
+        Generates a unit as a manifest followed by concurrent per-file calls,
+        so the unit is not capped by a single response's max_tokens.
+
+        Returns {"files": <files written>, "loc": <non-blank lines written>,
+        "missing": <manifest paths no call wrote>}. LOC counts only the
+        files written here, not leftovers already in output_path.
+        """
+        manifest = self.generate_manifest(
+            planner_output, unit_description, target_loc
+        )
+
+        chunks = [
+            manifest[i:i + files_per_call]
+            for i in range(0, len(manifest), files_per_call)
+        ]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            # Each call gets its own copy of the caller's context so usage
+            # keeps being attributed to the right codebase
+            futures = [
+                pool.submit(
+                    contextvars.copy_context().run,
+                    self.generate_files,
+                    planner_output,
+                    unit_description,
+                    manifest,
+                    chunk,
+                    output_path
+                )
+                for chunk in chunks
+            ]
+            written = set()
+            for future in futures:
+                written.update(future.result())
+
+        missing = sorted(
+            {Path(f["path"]).as_posix() for f in manifest} - written
+        )
+
+        return {
+            "files": len(written),
+            "loc": count_loc(output_path, written),
+            "missing": missing,
+        }
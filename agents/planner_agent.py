@@ -6,12 +6,22 @@ from pathlib import Path
 from anthropic import Anthropic
 from dotenv import load_dotenv
 
+from schemas import load_planner_output_schema
+
 # Load .env once
 load_dotenv()
 
 
+PLAN_TOOL_NAME = "submit_architecture"
+
+
 class PlannerAgent:
-    def __init__(self, system_prompt_path: str):
+    def __init__(
+        self,
+        system_prompt_path: str,
+        usage_callback=None,
+        structured_output: bool = False
+    ):
         api_key = os.getenv("ANTHROPIC_API_KEY")
 
         if not api_key:
@@ -22,6 +32,11 @@ class PlannerAgent:
 
         self.client = Anthropic(api_key=api_key)
         self.system_prompt = Path(system_prompt_path).read_text(encoding="utf-8")
+        # Optional hook called with (model, usage) after every API call
+        self.usage_callback = usage_callback
+        # Request the plan as a forced tool call whose input_schema is
+        # planner_output.schema.json instead of free-text JSON
+        self.structured_output = structured_output
 
     def run(self, planner_input: dict) -> dict:
         """
@@ -34,6 +49,9 @@ class PlannerAgent:
             planner_output (dict) — strict JSON, conforms to planner_output.schema.json
         """
 
+        if self.structured_output:
+            return self._run_structured(planner_input)
+
         response = self.client.messages.create(
             model="claude-3-5-haiku-20241022",
             max_tokens=8000,
@@ -47,6 +65,9 @@ class PlannerAgent:
             ]
         )
 
+        if self.usage_callback is not None:
+            self.usage_callback(response.model, response.usage)
+
         raw_text = response.content[0].text.strip()
 
         try:
@@ -58,3 +79,47 @@ class PlannerAgent:
             ) from e
 
         return planner_output
+
+    def _run_structured(self, planner_input: dict) -> dict:
+        """
+        Same contract as run(), but the model must answer with a single
+        tool call; its input is already parsed JSON shaped by the schema.
+        """
+        input_schema = load_planner_output_schema()
+        input_schema.pop("$schema", None)
+
+        response = self.client.messages.create(
+            model="claude-3-5-haiku-20241022",
+            max_tokens=8000,
+            temperature=0.3,  # architectural determinism
+            system=self.system_prompt,
+            tools=[
+                {
+                    "name": PLAN_TOOL_NAME,
+                    "description": input_schema["description"],
+                    "input_schema": input_schema
+                }
+            ],
+            tool_choice={"type": "tool", "name": PLAN_TOOL_NAME},
+            messages=[
+                {
+                    "role": "user",
+                    "content": json.dumps(planner_input)
+                }
+            ]
+        )
+
+        if self.usage_callback is not None:
+            self.usage_callback(response.model, response.usage)
+
+        for block in response.content:
+            if block.type == "tool_use" and block.name == PLAN_TOOL_NAME:
+                if not isinstance(block.input, dict):
+                    break
+                return block.input
+
+        raise ValueError(
+            f"Planner response contained no '{PLAN_TOOL_NAME}' tool call "
+            f"(stop_reason={response.stop_reason}). "
+            "This violates the Planner Agent contract."
+        )
@@ -1,14 +1,18 @@
 # graph/graph.py
 
 from typing import TypedDict, NotRequired
+from collections import Counter
+from functools import partial
 from pathlib import Path
+import copy
 import json
+import threading
 import uuid
 
 from langgraph.graph import StateGraph, END
 from jsonschema import validate, ValidationError
 
-from agents.codegen_agent import CodeGenAgent
+from agents.codegen_agent import CodeGenAgent, count_loc
 from agents.planner_agent import PlannerAgent
 from schemas import (
     load_planner_input_schema,
@@ -26,6 +30,12 @@ class GraphState(TypedDict):
     codebase_id: str
     codebase_path: str
     codebase_index: NotRequired[int]
+    service_loc: NotRequired[dict]
+    # service_name -> manifest paths hierarchical codegen never wrote
+    missing_files: NotRequired[dict]
+    # Near-duplicate plan handling, see dedup_node
+    replan_count: NotRequired[int]
+    replan_requested: NotRequired[bool]
 
 
 # -----------------------------
@@ -36,6 +46,18 @@ def generate_codebase_id() -> str:
     return f"codebase_{uuid.uuid4().hex[:8]}"
 
 
+def parse_loc_range(loc_range: str) -> tuple[int, int]:
+    """'10k-30k' -> (10000, 30000)."""
+    def parse(bound: str) -> int:
+        bound = bound.strip().lower()
+        if bound.endswith("k"):
+            return int(float(bound[:-1]) * 1000)
+        return int(bound)
+
+    low, _, high = loc_range.partition("-")
+    return parse(low), parse(high or low)
+
+
 def persist_json(path: Path, data: dict):
     path.parent.mkdir(parents=True, exist_ok=True)
     path.write_text(json.dumps(data, indent=2))
@@ -361,6 +383,76 @@ def _normalize_risk_analysis(planner_output: dict) -> None:
         planner_output[key] = normalized
 
 
+# Applied in this order after every planner call; keyed by the section each one repairs
+PLANNER_OUTPUT_NORMALIZERS = [
+    ("risk_analysis", _normalize_risk_analysis),
+    ("async_and_background_processing", _normalize_async_and_background),
+    ("system_overview", _normalize_system_overview),
+    ("expected_vulnerabilities", _normalize_expected_vulnerabilities),
+    ("service_architecture", _normalize_service_architecture),
+    ("data_flows", _normalize_data_flows),
+    ("trust_boundaries", _normalize_trust_boundaries),
+    ("design_tradeoffs", _normalize_design_tradeoffs),
+]
+
+
+def normalize_planner_output(planner_output: dict) -> list[str]:
+    """
+    Runs every normalizer over planner_output in place.
+    Returns the sections a normalizer actually had to change.
+    """
+    repaired = []
+    for section, normalize in PLANNER_OUTPUT_NORMALIZERS:
+        before = copy.deepcopy(planner_output.get(section))
+        normalize(planner_output)
+        if planner_output.get(section) != before:
+            repaired.append(section)
+    return repaired
+
+
+class RepairStats:
+    """
+    Per-section repair rates of planner output, kept separately for the
+    free-text ("text") and tool-call ("structured") planner modes so the
+    two can be compared over a batch.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = Counter()
+        self.parse_failures = Counter()
+        self.schema_failures = Counter()
+        self.repairs = {}
+
+    def record_parse_failure(self, mode: str) -> None:
+        with self._lock:
+            self.calls[mode] += 1
+            self.parse_failures[mode] += 1
+
+    def record(self, mode: str, repaired_sections: list[str], schema_valid: bool) -> None:
+        with self._lock:
+            self.calls[mode] += 1
+            self.repairs.setdefault(mode, Counter()).update(repaired_sections)
+            if not schema_valid:
+                self.schema_failures[mode] += 1
+
+    def report(self) -> dict:
+        with self._lock:
+            report = {}
+            for mode, calls in self.calls.items():
+                repairs = self.repairs.get(mode, Counter())
+                report[mode] = {
+                    "calls": calls,
+                    "parse_failure_rate": self.parse_failures[mode] / calls,
+                    "schema_failure_rate": self.schema_failures[mode] / calls,
+                    "repair_rate_by_section": {
+                        section: repairs[section] / calls
+                        for section, _ in PLANNER_OUTPUT_NORMALIZERS
+                    },
+                }
+            return report
+
+
 # -----------------------------
 # Graph Nodes
 # -----------------------------
@@ -416,7 +508,12 @@ def _normalize_risk_analysis(planner_output: dict) -> None:
 #         "codebase_path": str(codebase_path)
 #     }
 
-def planner_node(state: GraphState) -> GraphState:
+def planner_node(
+    state: GraphState,
+    usage_callback=None,
+    structured_output: bool = False,
+    repair_stats: RepairStats | None = None
+) -> GraphState:
     """Runs Planner Agent with strict schema validation."""
 
     # Validate planner input
@@ -429,20 +526,21 @@ def planner_node(state: GraphState) -> GraphState:
         raise RuntimeError(f"Planner input schema violation: {e.message}")
 
     planner = PlannerAgent(
-        system_prompt_path="prompts/planner.system.txt"
+        system_prompt_path="prompts/planner.system.txt",
+        usage_callback=usage_callback,
+        structured_output=structured_output
     )
+    mode = "structured" if structured_output else "text"
 
-    planner_output = planner.run(state["planner_input"])
+    try:
+        planner_output = planner.run(state["planner_input"])
+    except ValueError:
+        if repair_stats is not None:
+            repair_stats.record_parse_failure(mode)
+        raise
 
     # Normalize the output to fill missing fields
-    _normalize_risk_analysis(planner_output)
-    _normalize_async_and_background(planner_output)
-    _normalize_system_overview(planner_output)
-    _normalize_expected_vulnerabilities(planner_output)
-    _normalize_service_architecture(planner_output)
-    _normalize_data_flows(planner_output)
-    _normalize_trust_boundaries(planner_output)
-    _normalize_design_tradeoffs(planner_output)
+    repaired_sections = normalize_planner_output(planner_output)
 
     # Validate planner output
     try:
@@ -451,10 +549,15 @@ def planner_node(state: GraphState) -> GraphState:
             schema=load_planner_output_schema()
         )
     except ValidationError as e:
+        if repair_stats is not None:
+            repair_stats.record(mode, repaired_sections, schema_valid=False)
         raise RuntimeError(
             f"Planner output schema violation: {e.message}"
         )
 
+    if repair_stats is not None:
+        repair_stats.record(mode, repaired_sections, schema_valid=True)
+
     codebase_index = state.get("codebase_index")
     codebase_id = f"codebase{codebase_index}" if codebase_index is not None else generate_codebase_id()
     codebase_path = Path("codebases") / codebase_id
@@ -473,17 +576,86 @@ def planner_node(state: GraphState) -> GraphState:
 
 
 
-def codegen_node(state: GraphState) -> GraphState:
+def dedup_node(
+    state: GraphState,
+    similarity_index,
+    threshold: float,
+    max_replans: int
+) -> GraphState:
+    """
+    Checks the fresh plan against already generated codebases before any
+    codegen call is spent. A near-duplicate sends the graph back to the
+    planner, with the rejected services listed under
+    constraints.avoid_architectures, up to max_replans times.
+    """
     planner_output = state["planner_output"]
+
+    replan_count = state.get("replan_count", 0)
+    # The indexed plan under this codebase's own id is about to be overwritten
+    matches = [
+        match for match in similarity_index.similar_plans(planner_output, threshold)
+        if match[0] != state["codebase_id"]
+    ]
+
+    if not matches or replan_count >= max_replans:
+        return {
+            **state,
+            "replan_requested": False
+        }
+
+    duplicate_of, similarity = matches[0]
+    planner_input = copy.deepcopy(state["planner_input"])
+    planner_input["constraints"].setdefault("avoid_architectures", []).append({
+        "similar_to": duplicate_of,
+        "similarity": round(similarity, 2),
+        "services": [
+            s["service_name"] for s in planner_output["service_architecture"]
+        ]
+    })
+
+    return {
+        **state,
+        "planner_input": planner_input,
+        "replan_count": replan_count + 1,
+        "replan_requested": True
+    }
+
+
+def route_after_dedup(state: GraphState) -> str:
+    return "planner" if state.get("replan_requested") else "codegen"
+
+
+def codegen_node(
+    state: GraphState,
+    usage_callback=None,
+    hierarchical: bool = False
+) -> GraphState:
     codebase_path = Path(state["codebase_path"])
 
+    planner_output = state["planner_output"]
+    # Serialized once per codebase rather than once per generate_* call
+    prompt_planner_output = json.dumps(planner_output)
+
     codegen = CodeGenAgent(
-        system_prompt_path="prompts/codegen.system.txt"
+        system_prompt_path="prompts/codegen.system.txt",
+        usage_callback=usage_callback
     )
 
+    services = planner_output["service_architecture"]
+    if hierarchical:
+        loc_low, loc_high = parse_loc_range(
+            state["planner_input"]["constraints"]["scale"]["loc_range"]
+        )
+        # Aim for the middle of the codebase-wide range, split evenly
+        target_loc = (loc_low + loc_high) // 2 // len(services)
+
+    service_loc = {}
+    missing_files = {}
+
     # Generate services incrementally
-    for service in planner_output["service_architecture"]:
+    for service in services:
         service_name = service["service_name"]
+        service_path = codebase_path / "services" / service_name
 
         unit_description = (
             f"Implement service '{service_name}' exactly as described. "
@@ -493,13 +665,29 @@ def codegen_node(state: GraphState) -> GraphState:
             f"Data owned: {service['data_owned']}."
         )
 
-        codegen.generate_unit(
-            planner_output=planner_output,
-            unit_description=unit_description,
-            output_path=codebase_path / "services" / service_name
-        )
+        if hierarchical:
+            result = codegen.generate_unit_hierarchical(
+                planner_output=prompt_planner_output,
+                unit_description=unit_description,
+                output_path=service_path,
+                target_loc=target_loc
+            )
+            service_loc[service_name] = result["loc"]
+            if result["missing"]:
+                missing_files[service_name] = result["missing"]
+        else:
+            written = codegen.generate_unit(
+                planner_output=prompt_planner_output,
+                unit_description=unit_description,
+                output_path=service_path
+            )
+            service_loc[service_name] = count_loc(service_path, written)
 
-    return state
+    return {
+        **state,
+        "service_loc": service_loc,
+        "missing_files": missing_files
+    }
 
 
 def generate_vulnerability_report(planner_output: dict) -> dict:
@@ -513,14 +701,56 @@ def generate_vulnerability_report(planner_output: dict) -> dict:
 # Graph Assembly
 # -----------------------------
 
-def build_graph():
+def build_graph(
+    usage_callback=None,
+    structured_output: bool = False,
+    repair_stats: RepairStats | None = None,
+    hierarchical_codegen: bool = False,
+    similarity_index=None,
+    dedup_threshold: float = 0.8,
+    max_replans: int = 2
+):
+    """
+    usage_callback, if given, is called with (model, usage) after every
+    Anthropic API call made by the planner and codegen agents.
+
+    structured_output makes the planner answer through a tool call typed
+    by planner_output.schema.json; repair_stats, if given, collects how
+    often each section still needed normalizing.
+
+    hierarchical_codegen generates each service as a file manifest
+    followed by concurrent per-file calls instead of a single response.
+
+    similarity_index, if given, is checked after planning; plans at least
+    dedup_threshold similar to an indexed codebase are re-planned up to
+    max_replans times before codegen runs.
+    """
     graph = StateGraph(GraphState)
 
-    graph.add_node("planner", planner_node)
-    graph.add_node("codegen", codegen_node)
+    graph.add_node("planner", partial(
+        planner_node,
+        usage_callback=usage_callback,
+        structured_output=structured_output,
+        repair_stats=repair_stats
+    ))
+    graph.add_node("codegen", partial(
+        codegen_node,
+        usage_callback=usage_callback,
+        hierarchical=hierarchical_codegen
+    ))
 
     graph.set_entry_point("planner")
-    graph.add_edge("planner", "codegen")
+    if similarity_index is not None:
+        graph.add_node("dedup", partial(
+            dedup_node,
+            similarity_index=similarity_index,
+            threshold=dedup_threshold,
+            max_replans=max_replans
+        ))
+        graph.add_edge("planner", "dedup")
+        graph.add_conditional_edges("dedup", route_after_dedup, ["planner", "codegen"])
+    else:
+        graph.add_edge("planner", "codegen")
     graph.add_edge("codegen", END)
 
     return graph.compile()
@@ -0,0 +1,217 @@
+# runner/budget.py
+
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+
+# USD per million tokens: (input, output, cache write, cache read)
+PRICING_PER_MTOK = {
+    "claude-3-5-haiku-20241022": (0.80, 4.00, 1.00, 0.08),
+}
+DEFAULT_PRICING = PRICING_PER_MTOK["claude-3-5-haiku-20241022"]
+
+# Codebase index the current API call is being made for
+_current_codebase = contextvars.ContextVar("current_codebase", default=None)
+
+
+def usage_cost(model: str, usage) -> float:
+    """Dollar cost of a single response.usage block."""
+    input_rate, output_rate, cache_write_rate, cache_read_rate = (
+        PRICING_PER_MTOK.get(model, DEFAULT_PRICING)
+    )
+    return (
+        (getattr(usage, "input_tokens", 0) or 0) * input_rate
+        + (getattr(usage, "output_tokens", 0) or 0) * output_rate
+        + (getattr(usage, "cache_creation_input_tokens", 0) or 0) * cache_write_rate
+        + (getattr(usage, "cache_read_input_tokens", 0) or 0) * cache_read_rate
+    ) / 1_000_000
+
+
+def usage_tokens(usage) -> int:
+    return sum(
+        getattr(usage, field, 0) or 0
+        for field in (
+            "input_tokens",
+            "output_tokens",
+            "cache_creation_input_tokens",
+            "cache_read_input_tokens",
+        )
+    )
+
+
+class BudgetController:
+    """
+    Admission control for batch generation.
+
+    Tracks actual response.usage per API call, attributed to the codebase
+    being generated, and projects the cost of one more codebase from the
+    running averages of completed ones. New codebases are refused once a
+    token, dollar or wall-clock limit would be exceeded; codebases that
+    were already admitted are never interrupted, so no half-generated
+    trees are left behind.
+
+    Only successful codebases feed the averages; the spend of failed ones
+    still counts against the limits. Until the first codebase succeeds
+    there is nothing to project from, so while a limit is set only one
+    codebase is admitted at a time.
+    """
+
+    def __init__(
+        self,
+        max_tokens: int | None = None,
+        max_cost_usd: float | None = None,
+        max_wall_seconds: float | None = None
+    ):
+        self.max_tokens = max_tokens
+        self.max_cost_usd = max_cost_usd
+        self.max_wall_seconds = max_wall_seconds
+
+        self._lock = threading.Lock()
+        # Notified whenever an in-flight codebase finishes
+        self._finished = threading.Condition(self._lock)
+        self._started_at = time.monotonic()
+
+        self.spent_tokens = 0
+        self.spent_cost_usd = 0.0
+
+        # codebase_index -> {"tokens", "cost_usd", "started_at"}
+        self._in_flight = {}
+        self._completed = []
+        self.failed = 0
+        self.refusal_reason = None
+
+    # -----------------------------
+    # Usage accounting
+    # -----------------------------
+
+    def record_usage(self, model: str, usage) -> None:
+        """usage_callback for the agents; see graph.build_graph."""
+        tokens = usage_tokens(usage)
+        cost = usage_cost(model, usage)
+        codebase_index = _current_codebase.get()
+
+        with self._lock:
+            self.spent_tokens += tokens
+            self.spent_cost_usd += cost
+            entry = self._in_flight.get(codebase_index)
+            if entry is not None:
+                entry["tokens"] += tokens
+                entry["cost_usd"] += cost
+
+    # -----------------------------
+    # Admission
+    # -----------------------------
+
+    def _averages(self) -> tuple[float, float, float] | None:
+        if not self._completed:
+            return None
+        n = len(self._completed)
+        return (
+            sum(c["tokens"] for c in self._completed) / n,
+            sum(c["cost_usd"] for c in self._completed) / n,
+            sum(c["seconds"] for c in self._completed) / n,
+        )
+
+    def _check(self) -> str | None:
+        """Returns the reason a new codebase would break the budget, if any."""
+        now = time.monotonic()
+        averages = self._averages()
+
+        if averages is None:
+            # Nothing to project from yet; only refuse once a limit is hit
+            projected_tokens = self.spent_tokens
+            projected_cost = self.spent_cost_usd
+            projected_finish = now - self._started_at
+        else:
+            avg_tokens, avg_cost, avg_seconds = averages
+            # Remaining spend of in-flight codebases plus one new codebase
+            projected_tokens = self.spent_tokens + avg_tokens + sum(
+                max(avg_tokens - c["tokens"], 0) for c in self._in_flight.values()
+            )
+            projected_cost = self.spent_cost_usd + avg_cost + sum(
+                max(avg_cost - c["cost_usd"], 0) for c in self._in_flight.values()
+            )
+            projected_finish = now - self._started_at + avg_seconds
+
+        if self.max_tokens is not None and projected_tokens > self.max_tokens:
+            return (
+                f"token budget: projected {projected_tokens:.0f} "
+                f"> {self.max_tokens}"
+            )
+        if self.max_cost_usd is not None and projected_cost > self.max_cost_usd:
+            return (
+                f"cost budget: projected ${projected_cost:.2f} "
+                f"> ${self.max_cost_usd:.2f}"
+            )
+        if self.max_wall_seconds is not None and projected_finish > self.max_wall_seconds:
+            return (
+                f"wall-clock budget: projected {projected_finish:.0f}s "
+                f"> {self.max_wall_seconds:.0f}s"
+            )
+        return None
+
+    def _has_limit(self) -> bool:
+        return (
+            self.max_tokens is not None
+            or self.max_cost_usd is not None
+            or self.max_wall_seconds is not None
+        )
+
+    def admit(self, codebase_index: int) -> bool:
+        """
+        Registers codebase_index as in flight if the budget allows one
+        more codebase. Once refused, every later call is refused too.
+
+        Blocks while there is no baseline average yet and another
+        codebase is still in flight.
+        """
+        with self._lock:
+            if self._has_limit():
+                self._finished.wait_for(
+                    lambda: self._completed or not self._in_flight
+                )
+            if self.refusal_reason is None:
+                self.refusal_reason = self._check()
+            if self.refusal_reason is not None:
+                return False
+            self._in_flight[codebase_index] = {
+                "tokens": 0,
+                "cost_usd": 0.0,
+                "started_at": time.monotonic(),
+            }
+            return True
+
+    @contextmanager
+    def track(self, codebase_index: int):
+        """Attributes API usage in this context to an admitted codebase."""
+        token = _current_codebase.set(codebase_index)
+        succeeded = False
+        try:
+            yield
+            succeeded = True
+        finally:
+            _current_codebase.reset(token)
+            with self._lock:
+                entry = self._in_flight.pop(codebase_index)
+                # Partial spend of a failed codebase would drag the averages down
+                if succeeded:
+                    self._completed.append({
+                        "tokens": entry["tokens"],
+                        "cost_usd": entry["cost_usd"],
+                        "seconds": time.monotonic() - entry["started_at"],
+                    })
+                else:
+                    self.failed += 1
+                self._finished.notify_all()
+
+    def summary(self) -> str:
+        with self._lock:
+            return (
+                f"{len(self._completed)} codebases, "
+                f"{self.failed} failed, "
+                f"{self.spent_tokens} tokens, "
+                f"${self.spent_cost_usd:.2f}, "
+                f"{time.monotonic() - self._started_at:.0f}s"
+            )
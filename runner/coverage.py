@@ -0,0 +1,236 @@
+# runner/coverage.py
+
+import copy
+import hashlib
+import json
+import threading
+from collections import Counter
+from pathlib import Path
+
+
+# Languages the planner is steered toward when they are under-represented
+CANDIDATE_LANGUAGES = [
+    "Python",
+    "Go",
+    "Java",
+    "TypeScript",
+    "Rust",
+    "Kotlin",
+    "C#",
+    "Ruby",
+]
+
+# Bounds of constraints.scale.services ("6-10")
+SERVICE_COUNT_RANGE = range(6, 11)
+
+
+def _normalize_language(language: str) -> str:
+    """'TypeScript/React' -> 'TypeScript', 'Python (FastAPI)' -> 'Python'."""
+    return language.split("/")[0].split("(")[0].strip() or "unknown"
+
+
+def _least_covered(candidates, count, limit: int) -> tuple[list, list]:
+    """
+    Returns (candidates least-covered first, up to limit priorities).
+    Only candidates strictly below the best-covered one are priorities,
+    so a fully tied tally (e.g. an empty corpus) yields none; ties keep
+    the configured order.
+    """
+    ordered = sorted(candidates, key=count)
+    top = max((count(c) for c in ordered), default=0)
+    return ordered, [c for c in ordered if count(c) < top][:limit]
+
+
+class CoverageScheduler:
+    """
+    Keeps a running tally of the vulnerability classes, languages and
+    service counts achieved by persisted codebases, and shapes the next
+    planner_input toward under-represented cells.
+
+    Class counts come from each codebase's vulnerabilities.json
+    (summary.distribution_by_class); languages and service counts come
+    from the planner_output.json next to it when present.
+
+    Targets handed out by next_planner_input are reserved until the
+    codebase is recorded or its reservation released, so concurrent
+    codebases are steered toward different cells instead of all
+    chasing the same gap.
+    """
+
+    def __init__(
+        self,
+        vulnerability_classes: list[str],
+        codebases_dir: str | Path = "codebases",
+        max_priority_classes: int = 4,
+        max_priority_languages: int = 3
+    ):
+        self.vulnerability_classes = list(vulnerability_classes)
+        self.codebases_dir = Path(codebases_dir)
+        self.max_priority_classes = max_priority_classes
+        self.max_priority_languages = max_priority_languages
+
+        self._lock = threading.Lock()
+        # resolved codebase path -> {"sha256", "classes", "languages", "service_count"}
+        self._contributions = {}
+
+        self.class_counts = Counter({c: 0 for c in self.vulnerability_classes})
+        self.language_counts = Counter({l: 0 for l in CANDIDATE_LANGUAGES})
+        self.service_count_counts = Counter({n: 0 for n in SERVICE_COUNT_RANGE})
+
+        # reservation -> {"classes", "languages", "service_count"} handed out
+        # to a codebase that is still being generated
+        self._reservations = {}
+        self._reserved = {
+            "classes": Counter(),
+            "languages": Counter(),
+            "service_count": Counter(),
+        }
+
+    # -----------------------------
+    # Tally
+    # -----------------------------
+
+    def scan(self) -> int:
+        """Records every persisted codebase that is new or changed. Returns how many were."""
+        if not self.codebases_dir.is_dir():
+            return 0
+        added = 0
+        for codebase_path in sorted(self.codebases_dir.iterdir()):
+            if self.record(codebase_path):
+                added += 1
+        return added
+
+    def record(self, codebase_path: str | Path, reservation=None) -> bool:
+        """
+        Adds one codebase to the tally, releasing the targets reserved
+        for it under reservation. run_batch reuses codebaseN directories,
+        so a path whose content changed since it was last recorded
+        replaces its previous contribution. Returns False if the codebase
+        is absent or unchanged.
+        """
+        codebase_path = Path(codebase_path)
+        vuln_path = codebase_path / "vulnerabilities.json"
+        if not vuln_path.is_file():
+            self.release(reservation)
+            return False
+
+        vuln_text = vuln_path.read_text()
+        planner_output_path = codebase_path / "planner_output.json"
+        planner_output_text = (
+            planner_output_path.read_text() if planner_output_path.is_file() else ""
+        )
+        sha256 = hashlib.sha256((vuln_text + planner_output_text).encode()).hexdigest()
+
+        key = codebase_path.resolve()
+        with self._lock:
+            previous = self._contributions.get(key)
+            if previous is not None and previous["sha256"] == sha256:
+                self._release(reservation)
+                return False
+
+        vuln_report = json.loads(vuln_text)
+        distribution = vuln_report.get("summary", {}).get("distribution_by_class", {})
+        services = (
+            json.loads(planner_output_text).get("service_architecture", [])
+            if planner_output_text else []
+        )
+
+        contribution = {
+            "sha256": sha256,
+            "classes": Counter(distribution),
+            "languages": Counter(
+                _normalize_language(service.get("language", "")) for service in services
+            ),
+            "service_count": Counter([len(services)] if services else []),
+        }
+
+        with self._lock:
+            previous = self._contributions.get(key)
+            if previous is not None:
+                self.class_counts.subtract(previous["classes"])
+                self.language_counts.subtract(previous["languages"])
+                self.service_count_counts.subtract(previous["service_count"])
+            self.class_counts.update(contribution["classes"])
+            self.language_counts.update(contribution["languages"])
+            self.service_count_counts.update(contribution["service_count"])
+            self._contributions[key] = contribution
+            # Same critical section, so the targets are never counted
+            # twice or not at all
+            self._release(reservation)
+        return True
+
+    def release(self, reservation):
+        """Drops the targets reserved under reservation, e.g. after a failed codebase."""
+        with self._lock:
+            self._release(reservation)
+
+    def _release(self, reservation):
+        held = self._reservations.pop(reservation, None)
+        if held is not None:
+            for kind, counts in held.items():
+                self._reserved[kind].subtract(counts)
+
+    # -----------------------------
+    # Scheduling
+    # -----------------------------
+
+    def next_planner_input(self, base_input: dict, reservation=None) -> dict:
+        """
+        Returns a copy of base_input whose constraints favour the
+        least-covered classes, languages and service count so far,
+        counting targets reserved for codebases still in flight.
+
+        With a reservation key the chosen targets are reserved (one unit
+        per priority class, priority language and service count) until
+        record() or release() is called with the same key.
+        """
+        with self._lock:
+            reserved = self._reserved
+            classes, priority_classes = _least_covered(
+                self.vulnerability_classes,
+                lambda c: self.class_counts[c] + reserved["classes"][c],
+                self.max_priority_classes
+            )
+            _, priority_languages = _least_covered(
+                CANDIDATE_LANGUAGES,
+                lambda l: self.language_counts[l] + reserved["languages"][l],
+                self.max_priority_languages
+            )
+            _, service_counts = _least_covered(
+                SERVICE_COUNT_RANGE,
+                lambda n: self.service_count_counts[n] + reserved["service_count"][n],
+                1
+            )
+
+            if reservation is not None:
+                self._release(reservation)
+                held = {
+                    "classes": Counter(priority_classes),
+                    "languages": Counter(priority_languages),
+                    "service_count": Counter(service_counts),
+                }
+                for kind, counts in held.items():
+                    reserved[kind].update(counts)
+                self._reservations[reservation] = held
+
+        coverage_targets = {
+            "priority_vulnerability_classes": priority_classes,
+            "priority_languages": priority_languages,
+        }
+        if service_counts:
+            coverage_targets["service_count"] = service_counts[0]
+
+        planner_input = copy.deepcopy(base_input)
+        constraints = planner_input["constraints"]
+        constraints["vulnerability_classes"] = classes
+        constraints["coverage_targets"] = coverage_targets
+        return planner_input
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "codebases": len(self._contributions),
+                "vulnerability_classes": dict(self.class_counts),
+                "languages": dict(self.language_counts),
+                "service_counts": dict(self.service_count_counts),
+            }
@@ -0,0 +1,385 @@
+# runner/export_dataset.py
+"""
+Exports generated codebases as sharded JSONL for training / evaluation.
+
+Each record joins source files with the vulnerability labels from
+vulnerabilities.json whose affected_services name the file's service.
+
+    python runner/export_dataset.py --out dataset
+    python runner/export_dataset.py --out dataset --granularity file --compress
+
+Re-running against the same --out only appends codebases that are new
+or have changed since they were exported (run_batch reuses codebaseN
+directories); the stale records of a changed codebase are removed first
+and shards left empty are deleted. Only the services named in a
+codebase's planner_output.json are exported.
+export_manifest.json in the output directory records what is already
+there, including each shard's size on disk, so bytes written after the
+last manifest save by an interrupted export are truncated on resume.
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+_root = Path(__file__).resolve().parent.parent
+if str(_root) not in sys.path:
+    sys.path.insert(0, str(_root))
+
+MANIFEST_NAME = "export_manifest.json"
+GRANULARITIES = ("codebase", "file")
+
+
+def _service_key(name: str) -> str:
+    """'Order-Processing-Service' and 'order_processing' compare equal."""
+    key = name.strip().lower().replace("-", "_").replace(" ", "_")
+    return key.removesuffix("_service")
+
+
+def _read_json(path: Path) -> dict | None:
+    return json.loads(path.read_text()) if path.is_file() else None
+
+
+def codebase_fingerprint(codebase_path: Path) -> str:
+    """
+    Hash of the codebase's JSON artifacts plus the path, size and mtime
+    of every generated file, so regenerating a codebaseN directory is
+    detected without reading all of its source.
+    """
+    digest = hashlib.sha256()
+    for name in ("vulnerabilities.json", "planner_output.json"):
+        path = codebase_path / name
+        digest.update(name.encode())
+        if path.is_file():
+            digest.update(path.read_bytes())
+    services_dir = codebase_path / "services"
+    if services_dir.is_dir():
+        for file_path in sorted(services_dir.rglob("*")):
+            if file_path.is_file():
+                stat = file_path.stat()
+                digest.update(
+                    f"{file_path.relative_to(codebase_path).as_posix()}"
+                    f"\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode()
+                )
+    return digest.hexdigest()
+
+
+def _service_files(service_path: Path):
+    """Yields (relative path, text) for every UTF-8 file in a service."""
+    for file_path in sorted(service_path.rglob("*")):
+        if not file_path.is_file():
+            continue
+        try:
+            yield file_path.relative_to(service_path).as_posix(), file_path.read_text(encoding="utf-8")
+        except UnicodeDecodeError:
+            continue
+
+
+def build_records(codebase_path: Path, granularity: str) -> list[str]:
+    """Serialized JSONL lines for one codebase."""
+    codebase_id = codebase_path.name
+    vuln_report = _read_json(codebase_path / "vulnerabilities.json")
+    planner_output = _read_json(codebase_path / "planner_output.json")
+
+    vulnerabilities = vuln_report.get("vulnerabilities", [])
+    languages = {
+        _service_key(s["service_name"]): s.get("language")
+        for s in (planner_output or {}).get("service_architecture", [])
+    }
+
+    def labels_for(service_name: str) -> list[dict]:
+        key = _service_key(service_name)
+        return [
+            v for v in vulnerabilities
+            if key in {_service_key(s) for s in v.get("affected_services", [])}
+        ]
+
+    # run_batch reuses codebaseN directories, so services/ can still hold
+    # services of an earlier plan; only the planned ones are exported
+    services_dir = codebase_path / "services"
+    service_paths = sorted(
+        p for p in services_dir.iterdir()
+        if p.is_dir() and (planner_output is None or _service_key(p.name) in languages)
+    ) if services_dir.is_dir() else []
+
+    if granularity == "file":
+        lines = []
+        for service_path in service_paths:
+            service_name = service_path.name
+            labels = labels_for(service_name)
+            for relative_path, content in _service_files(service_path):
+                lines.append(json.dumps({
+                    "codebase_id": codebase_id,
+                    "service": service_name,
+                    "language": languages.get(_service_key(service_name)),
+                    "path": f"services/{service_name}/{relative_path}",
+                    "content": content,
+                    "vulnerabilities": labels,
+                }))
+        return lines
+
+    services = []
+    for service_path in service_paths:
+        service_name = service_path.name
+        services.append({
+            "service": service_name,
+            "language": languages.get(_service_key(service_name)),
+            "files": [
+                {"path": relative_path, "content": content}
+                for relative_path, content in _service_files(service_path)
+            ],
+            "vulnerabilities": [v.get("risk_id") for v in labels_for(service_name)],
+        })
+    return [json.dumps({
+        "codebase_id": codebase_id,
+        "planner_output": planner_output,
+        "summary": vuln_report.get("summary"),
+        "vulnerabilities": vulnerabilities,
+        "services": services,
+    })]
+
+
+class ShardWriter:
+    """Appends JSONL lines to numbered shards of at most max_shard_bytes (uncompressed)."""
+
+    def __init__(self, out_dir: Path, manifest: dict):
+        self.out_dir = out_dir
+        self.manifest = manifest
+        self.compress = manifest["compress"]
+        self.max_shard_bytes = manifest["max_shard_bytes"]
+        self._file = None
+        self._shard = None
+
+    def _shard_name(self, index: int) -> str:
+        return f"shard-{index:05d}.jsonl" + (".gz" if self.compress else "")
+
+    def _next_shard_name(self) -> str:
+        # Pruned shards leave gaps, so number after the highest one left
+        indexes = [int(shard["name"][6:11]) for shard in self.manifest["shards"]]
+        return self._shard_name(max(indexes, default=-1) + 1)
+
+    def _current_shard(self, incoming_bytes: int) -> dict:
+        shards = self.manifest["shards"]
+        if shards and shards[-1]["bytes"] + incoming_bytes <= self.max_shard_bytes:
+            shard = shards[-1]
+        elif shards and shards[-1]["records"] == 0:
+            # A single record larger than the bound still needs a home
+            shard = shards[-1]
+        else:
+            self.close()
+            shard = {"name": self._next_shard_name(), "bytes": 0, "records": 0}
+            shards.append(shard)
+
+        if self._file is None:
+            path = self.out_dir / shard["name"]
+            # Appending a new gzip member keeps earlier members readable
+            self._file = gzip.open(path, "ab") if self.compress else open(path, "ab")
+            self._shard = shard
+        return shard
+
+    def write(self, line: str) -> str:
+        data = (line + "\n").encode("utf-8")
+        shard = self._current_shard(len(data))
+        self._file.write(data)
+        shard["bytes"] += len(data)
+        shard["records"] += 1
+        return shard["name"]
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            # Every close ends a whole gzip member, so this offset is
+            # always a safe point to truncate back to
+            self._shard["file_bytes"] = (self.out_dir / self._shard["name"]).stat().st_size
+            self._shard = None
+
+    def remove_codebase(self, codebase_id: str, shard_names: list[str]) -> list[str]:
+        """
+        Streams the named shards, dropping every record of codebase_id.
+        Shards left empty are dropped from the manifest; their names are
+        returned so the caller can delete the files once the manifest
+        is saved.
+        """
+        self.close()
+        # Both granularities serialize codebase_id as the first key
+        prefix = json.dumps({"codebase_id": codebase_id})[:-1].encode("utf-8") + b","
+        for shard in self.manifest["shards"]:
+            if shard["name"] not in shard_names:
+                continue
+            path = self.out_dir / shard["name"]
+            tmp_path = path.with_name(path.name + ".tmp")
+            opener = gzip.open if self.compress else open
+            shard["bytes"] = shard["records"] = 0
+            with opener(path, "rb") as src, opener(tmp_path, "wb") as dst:
+                for data in src:
+                    if data.startswith(prefix):
+                        continue
+                    dst.write(data)
+                    shard["bytes"] += len(data)
+                    shard["records"] += 1
+            tmp_path.replace(path)
+            shard["file_bytes"] = path.stat().st_size
+
+        emptied = [
+            shard["name"] for shard in self.manifest["shards"]
+            if shard["name"] in shard_names and shard["records"] == 0
+        ]
+        self.manifest["shards"] = [
+            shard for shard in self.manifest["shards"] if shard["name"] not in emptied
+        ]
+        return emptied
+
+
+def _load_manifest(out_dir: Path, granularity: str, compress: bool, max_shard_bytes: int) -> dict:
+    manifest = _read_json(out_dir / MANIFEST_NAME)
+    if manifest is None:
+        return {
+            "granularity": granularity,
+            "compress": compress,
+            "max_shard_bytes": max_shard_bytes,
+            "shards": [],
+            "codebases": {},
+        }
+    for option, value in (("granularity", granularity), ("compress", compress)):
+        if manifest[option] != value:
+            raise RuntimeError(
+                f"{out_dir} was exported with {option}={manifest[option]!r}; "
+                f"use a fresh output directory for {option}={value!r}."
+            )
+    manifest["max_shard_bytes"] = max_shard_bytes
+    return manifest
+
+
+def _repair_shards(out_dir: Path, manifest: dict):
+    """Drops whatever an interrupted export wrote after the last manifest save."""
+    known = set()
+    for shard in manifest["shards"]:
+        known.add(shard["name"])
+        path = out_dir / shard["name"]
+        if not path.is_file():
+            raise RuntimeError(f"{path} is listed in {MANIFEST_NAME} but missing.")
+        if path.stat().st_size > shard.get("file_bytes", path.stat().st_size):
+            with open(path, "r+b") as f:
+                f.truncate(shard["file_bytes"])
+    for path in out_dir.glob("shard-*.jsonl*"):
+        if path.name not in known:
+            path.unlink()
+
+
+def _save_manifest(out_dir: Path, manifest: dict):
+    tmp_path = out_dir / (MANIFEST_NAME + ".tmp")
+    tmp_path.write_text(json.dumps(manifest, indent=2))
+    tmp_path.replace(out_dir / MANIFEST_NAME)
+
+
+def export_dataset(
+    codebases_dir: str | Path = "codebases",
+    out_dir: str | Path = "dataset",
+    granularity: str = "codebase",
+    compress: bool = False,
+    max_shard_bytes: int = 256 * 1024 * 1024,
+    max_workers: int = 4
+) -> int:
+    """
+    Streams every finished codebase that is new or changed since it was
+    exported into JSONL shards. A codebase is finished once its
+    vulnerabilities.json exists.
+
+    Codebases are read on a thread pool but at most 2 * max_workers are
+    held in memory at once, and they are written in name order so shard
+    contents are deterministic. Returns the number of codebases exported.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"granularity must be one of {GRANULARITIES}")
+
+    codebases_dir = Path(codebases_dir)
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+
+    manifest = _load_manifest(out_dir, granularity, compress, max_shard_bytes)
+    _repair_shards(out_dir, manifest)
+
+    pending = []
+    if codebases_dir.is_dir():
+        for p in sorted(codebases_dir.iterdir()):
+            if not (p / "vulnerabilities.json").is_file():
+                continue
+            fingerprint = codebase_fingerprint(p)
+            exported_entry = manifest["codebases"].get(p.name)
+            if exported_entry is None or exported_entry.get("fingerprint") != fingerprint:
+                pending.append((p, fingerprint))
+
+    writer = ShardWriter(out_dir, manifest)
+    exported = 0
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            window = deque()
+            remaining = iter(pending)
+
+            def fill():
+                while len(window) < 2 * max_workers:
+                    item = next(remaining, None)
+                    if item is None:
+                        return
+                    codebase_path, fingerprint = item
+                    window.append((
+                        codebase_path,
+                        fingerprint,
+                        pool.submit(build_records, codebase_path, granularity)
+                    ))
+
+            fill()
+            while window:
+                codebase_path, fingerprint, future = window.popleft()
+                lines = future.result()
+
+                stale = manifest["codebases"].pop(codebase_path.name, None)
+                if stale is not None:
+                    emptied = writer.remove_codebase(codebase_path.name, stale["shards"])
+                    _save_manifest(out_dir, manifest)
+                    # Unlisted now; _repair_shards removes them if this is interrupted
+                    for name in emptied:
+                        (out_dir / name).unlink()
+
+                shards = sorted({writer.write(line) for line in lines})
+                manifest["codebases"][codebase_path.name] = {
+                    "fingerprint": fingerprint,
+                    "records": len(lines),
+                    "shards": shards,
+                }
+                exported += 1
+                # Shard data must be on disk before the manifest claims it
+                writer.close()
+                _save_manifest(out_dir, manifest)
+                fill()
+    finally:
+        writer.close()
+
+    return exported
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--codebases", default="codebases")
+    parser.add_argument("--out", default="dataset")
+    parser.add_argument("--granularity", choices=GRANULARITIES, default="codebase")
+    parser.add_argument("--compress", action="store_true")
+    parser.add_argument("--max-shard-mb", type=int, default=256)
+    parser.add_argument("--workers", type=int, default=4)
+    args = parser.parse_args()
+
+    count = export_dataset(
+        codebases_dir=args.codebases,
+        out_dir=args.out,
+        granularity=args.granularity,
+        compress=args.compress,
+        max_shard_bytes=args.max_shard_mb * 1024 * 1024,
+        max_workers=args.workers
+    )
+    print(f"✔ Exported {count} new or changed codebases to {args.out}")
@@ -2,6 +2,8 @@
 
 import json
 import sys
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import nullcontext
 from pathlib import Path
 
 # Ensure project root is on path when running this script directly
@@ -9,7 +11,10 @@ _root = Path(__file__).resolve().parent.parent
 if str(_root) not in sys.path:
     sys.path.insert(0, str(_root))
 
-from graph.graph import build_graph
+from graph.graph import RepairStats, build_graph, generate_vulnerability_report
+from runner.budget import BudgetController
+from runner.coverage import CoverageScheduler
+from runner.similarity import SimilarityIndex
 
 
 def load_base_planner_input() -> dict:
@@ -51,36 +56,158 @@ def persist_vulnerabilities(codebase_path: Path, planner_output: dict):
     Vulnerabilities are derived STRICTLY from planner output.
     No code inspection. No injection.
     """
-    vuln_report = {
-        "summary": planner_output["expected_vulnerabilities"],
-        "vulnerabilities": planner_output["risk_analysis"]
-    }
+    vuln_report = generate_vulnerability_report(planner_output)
 
     (codebase_path / "vulnerabilities.json").write_text(
         json.dumps(vuln_report, indent=2)
     )
 
 
-def run_batch(total_codebases: int):
-    graph = build_graph()
-    base_input = load_base_planner_input()
+def generate_codebase(
+    graph,
+    base_input: dict,
+    codebase_index: int,
+    total_codebases: int,
+    budget: BudgetController | None = None,
+    scheduler: CoverageScheduler | None = None,
+    similarity_index: SimilarityIndex | None = None
+) -> Path:
+    print(f"\n=== Generating codebase {codebase_index}/{total_codebases} ===")
+
+    planner_input = (
+        scheduler.next_planner_input(base_input, reservation=codebase_index)
+        if scheduler else base_input
+    )
 
-    for i in range(total_codebases):
-        print(f"\n=== Generating codebase {i + 1}/{total_codebases} ===")
+    state = {
+        "planner_input": planner_input,
+        "codebase_index": codebase_index,
+    }
 
-        state = {
-            "planner_input": base_input,
-            "codebase_index": i + 1,
-        }
+    try:
+        with budget.track(codebase_index) if budget else nullcontext():
+            final_state = graph.invoke(state)
+
+            codebase_path = Path(final_state["codebase_path"])
+            persist_vulnerabilities(codebase_path, final_state["planner_output"])
+    except BaseException:
+        if scheduler:
+            scheduler.release(codebase_index)
+        raise
+
+    if scheduler:
+        scheduler.record(codebase_path, reservation=codebase_index)
+    if similarity_index:
+        similarity_index.add_codebase(codebase_path)
+        similarity_index.save()
+
+    if final_state.get("replan_count"):
+        print(f"  re-planned {final_state['replan_count']}x to avoid near-duplicates")
+    missing_files = final_state.get("missing_files", {})
+    for service_name, loc in final_state.get("service_loc", {}).items():
+        missing = missing_files.get(service_name)
+        if missing:
+            print(f"  {service_name}: {loc} LOC ({len(missing)} manifest files missing)")
+        else:
+            print(f"  {service_name}: {loc} LOC")
+    print(f"✔ Generated {codebase_path}")
+    return codebase_path
+
+
+def run_batch(
+    total_codebases: int,
+    budget: BudgetController | None = None,
+    max_workers: int = 1,
+    balance_coverage: bool = False,
+    structured_output: bool = False,
+    hierarchical_codegen: bool = False,
+    dedup_threshold: float | None = None,
+    max_replans: int = 2
+):
+    """
+    Generates up to total_codebases codebases, max_workers at a time.
 
-        final_state = graph.invoke(state)
+    With a budget, each codebase must be admitted before it starts. Once
+    the budget refuses, no new codebases are started but the ones already
+    in flight run to completion.
 
-        codebase_path = Path(final_state["codebase_path"])
-        planner_output = final_state["planner_output"]
+    With balance_coverage, each planner_input is shaped toward the
+    vulnerability classes, languages and service counts that are least
+    represented among the codebases already on disk.
 
-        persist_vulnerabilities(codebase_path, planner_output)
+    structured_output switches the planner to tool-call output; per-section
+    repair rates are printed at the end either way for comparison.
+
+    hierarchical_codegen generates each service from a file manifest with
+    concurrent per-file calls; achieved LOC is printed per service.
+
+    With dedup_threshold, each fresh plan is checked against a MinHash
+    index of the codebases already on disk and re-planned if it is at
+    least that similar to one of them, at most max_replans times.
+    dedup_threshold is used as given, so 0.0 re-plans every plan that
+    shares a band with any indexed one.
+    """
+    similarity_index = None
+    if dedup_threshold is not None:
+        similarity_index = SimilarityIndex.load(
+            Path("codebases") / "similarity_index.json"
+        )
+        similarity_index.update("codebases")
+
+    repair_stats = RepairStats()
+    graph = build_graph(
+        usage_callback=budget.record_usage if budget else None,
+        structured_output=structured_output,
+        repair_stats=repair_stats,
+        hierarchical_codegen=hierarchical_codegen,
+        similarity_index=similarity_index,
+        dedup_threshold=dedup_threshold,
+        max_replans=max_replans
+    )
+    base_input = load_base_planner_input()
 
-        print(f"✔ Generated {codebase_path}")
+    scheduler = None
+    if balance_coverage:
+        scheduler = CoverageScheduler(
+            base_input["constraints"]["vulnerability_classes"]
+        )
+        scheduler.scan()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        in_flight = set()
+
+        for i in range(total_codebases):
+            if len(in_flight) >= max_workers:
+                done, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    future.result()
+
+            if budget and not budget.admit(i + 1):
+                print(
+                    f"\n✖ Budget exhausted ({budget.refusal_reason}); "
+                    f"not starting codebase {i + 1}/{total_codebases}"
+                )
+                break
+
+            in_flight.add(pool.submit(
+                generate_codebase,
+                graph,
+                base_input,
+                i + 1,
+                total_codebases,
+                budget,
+                scheduler,
+                similarity_index
+            ))
+
+        for future in in_flight:
+            future.result()
+
+    print(f"\nPlanner repairs: {json.dumps(repair_stats.report())}")
+    if budget:
+        print(f"Budget used: {budget.summary()}")
+    if scheduler:
+        print(f"Coverage: {json.dumps(scheduler.report())}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,254 @@
+# runner/similarity.py
+
+import hashlib
+import json
+import random
+import re
+import threading
+from pathlib import Path
+
+
+# Sections that define an architecture; system_overview and
+# expected_vulnerabilities are near-identical across plans by design
+PLAN_SECTIONS = [
+    "service_architecture",
+    "data_flows",
+    "trust_boundaries",
+    "async_and_background_processing",
+    "design_tradeoffs",
+    "risk_analysis",
+]
+
+TOKEN_RE = re.compile(r"\w+")
+MERSENNE_PRIME = (1 << 61) - 1
+
+
+def _hash_shingle(shingle: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(),
+        "big"
+    )
+
+
+def _shingles(text: str, k: int, prefix: str = "") -> set[int]:
+    tokens = TOKEN_RE.findall(text.lower())
+    if len(tokens) < k:
+        return {_hash_shingle(prefix + " ".join(tokens))} if tokens else set()
+    return {
+        _hash_shingle(prefix + " ".join(tokens[i:i + k]))
+        for i in range(len(tokens) - k + 1)
+    }
+
+
+def plan_shingles(planner_output: dict) -> set[int]:
+    """Word 3-shingles of each architecture section, tagged by section."""
+    shingles = set()
+    for section in PLAN_SECTIONS:
+        text = json.dumps(planner_output.get(section), sort_keys=True)
+        shingles |= _shingles(text, 3, prefix=section + ":")
+    return shingles
+
+
+def code_shingles(codebase_path: Path, service_names=None) -> set[int]:
+    """
+    Word 5-shingles over every UTF-8 file under services/, or only under
+    the services named in service_names (a reused codebaseN directory
+    can still hold services of an earlier plan).
+    """
+    shingles = set()
+    services_dir = codebase_path / "services"
+    if not services_dir.is_dir():
+        return shingles
+    if service_names is None:
+        file_paths = services_dir.rglob("*")
+    else:
+        file_paths = (
+            file_path
+            for service_name in service_names
+            for file_path in (services_dir / service_name).rglob("*")
+        )
+    for file_path in sorted(file_paths):
+        if not file_path.is_file():
+            continue
+        try:
+            shingles |= _shingles(file_path.read_text(encoding="utf-8"), 5)
+        except UnicodeDecodeError:
+            continue
+    return shingles
+
+
+def _planned_services(planner_output: dict) -> list[str]:
+    """Directory names codegen_node writes the plan's services to."""
+    return [s["service_name"] for s in planner_output.get("service_architecture", [])]
+
+
+class SimilarityIndex:
+    """
+    MinHash signatures with banded LSH over generated codebases, kept in
+    two spaces: "plan" (planner_output sections) and "code" (source files).
+
+    Candidates come from LSH buckets and are then ranked by the Jaccard
+    similarity estimated from their signatures. With the default 16 bands
+    of 8 rows, pairs above ~0.7 Jaccard are very likely to collide.
+    """
+
+    KINDS = ("plan", "code")
+
+    def __init__(self, path: str | Path, num_perm: int = 128, bands: int = 16):
+        if num_perm % bands:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.path = Path(path)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+
+        # Fixed seed so signatures stay comparable across runs
+        rng = random.Random(0)
+        self._perms = [
+            (rng.randrange(1, MERSENNE_PRIME), rng.randrange(0, MERSENNE_PRIME))
+            for _ in range(num_perm)
+        ]
+
+        self._lock = threading.Lock()
+        self.signatures = {kind: {} for kind in self.KINDS}
+        # codebase_id -> sha256 of the planner_output.json it was indexed from
+        self.fingerprints = {}
+        self._buckets = {kind: {} for kind in self.KINDS}
+
+    # -----------------------------
+    # Persistence
+    # -----------------------------
+
+    @classmethod
+    def load(cls, path: str | Path, num_perm: int = 128, bands: int = 16) -> "SimilarityIndex":
+        index = cls(path, num_perm=num_perm, bands=bands)
+        if index.path.is_file():
+            data = json.loads(index.path.read_text())
+            if data["num_perm"] != num_perm or data["bands"] != bands:
+                raise RuntimeError(
+                    f"{index.path} was built with num_perm={data['num_perm']}, "
+                    f"bands={data['bands']}; delete it to rebuild."
+                )
+            for kind in cls.KINDS:
+                for codebase_id, signature in data["signatures"][kind].items():
+                    index._insert(kind, codebase_id, signature)
+            index.fingerprints.update(data.get("fingerprints", {}))
+        return index
+
+    def save(self):
+        with self._lock:
+            data = {
+                "num_perm": self.num_perm,
+                "bands": self.bands,
+                "signatures": self.signatures,
+                "fingerprints": self.fingerprints,
+            }
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = self.path.with_name(self.path.name + ".tmp")
+            tmp_path.write_text(json.dumps(data))
+            tmp_path.replace(self.path)
+
+    # -----------------------------
+    # MinHash / LSH
+    # -----------------------------
+
+    def signature(self, shingles: set[int]) -> list[int]:
+        if not shingles:
+            return [MERSENNE_PRIME] * self.num_perm
+        return [
+            min((a * h + b) % MERSENNE_PRIME for h in shingles)
+            for a, b in self._perms
+        ]
+
+    def _band_keys(self, signature: list[int]):
+        for band in range(self.bands):
+            start = band * self.rows
+            yield band, tuple(signature[start:start + self.rows])
+
+    def _insert(self, kind: str, codebase_id: str, signature: list[int]):
+        """Adds or replaces codebase_id's signature, moving it between buckets."""
+        with self._lock:
+            buckets = self._buckets[kind]
+            previous = self.signatures[kind].get(codebase_id)
+            if previous is not None:
+                for key in self._band_keys(previous):
+                    bucket = buckets.get(key)
+                    if bucket is not None:
+                        bucket.discard(codebase_id)
+                        if not bucket:
+                            del buckets[key]
+            self.signatures[kind][codebase_id] = signature
+            for key in self._band_keys(signature):
+                buckets.setdefault(key, set()).add(codebase_id)
+
+    def _query(self, kind: str, signature: list[int], threshold: float) -> list[tuple[str, float]]:
+        with self._lock:
+            candidates = set()
+            for key in self._band_keys(signature):
+                candidates |= self._buckets[kind].get(key, set())
+            matches = []
+            for codebase_id in candidates:
+                other = self.signatures[kind][codebase_id]
+                similarity = sum(x == y for x, y in zip(signature, other)) / self.num_perm
+                if similarity >= threshold:
+                    matches.append((codebase_id, similarity))
+        return sorted(matches, key=lambda m: m[1], reverse=True)
+
+    # -----------------------------
+    # Codebases
+    # -----------------------------
+
+    def add_codebase(self, codebase_path: str | Path) -> bool:
+        """
+        Indexes a finished codebase's plan and code. run_batch reuses
+        codebaseN directories, so a codebase whose planner_output.json
+        changed since it was indexed replaces its old signatures. Returns
+        False if it is unchanged or has no planner_output.json.
+        """
+        codebase_path = Path(codebase_path)
+        codebase_id = codebase_path.name
+        planner_output_path = codebase_path / "planner_output.json"
+        if not planner_output_path.is_file():
+            return False
+
+        planner_output_text = planner_output_path.read_text()
+        fingerprint = hashlib.sha256(planner_output_text.encode("utf-8")).hexdigest()
+        if self.fingerprints.get(codebase_id) == fingerprint:
+            return False
+
+        planner_output = json.loads(planner_output_text)
+        self._insert("plan", codebase_id, self.signature(plan_shingles(planner_output)))
+        self._insert("code", codebase_id, self.signature(
+            code_shingles(codebase_path, _planned_services(planner_output))
+        ))
+        with self._lock:
+            self.fingerprints[codebase_id] = fingerprint
+        return True
+
+    def update(self, codebases_dir: str | Path) -> int:
+        """Indexes every finished codebase that is new or changed."""
+        codebases_dir = Path(codebases_dir)
+        if not codebases_dir.is_dir():
+            return 0
+        added = 0
+        for codebase_path in sorted(codebases_dir.iterdir()):
+            if (codebase_path / "vulnerabilities.json").is_file() and self.add_codebase(codebase_path):
+                added += 1
+        return added
+
+    def similar_plans(self, planner_output: dict, threshold: float) -> list[tuple[str, float]]:
+        """Indexed codebases whose plan is at least threshold-similar, most similar first."""
+        return self._query("plan", self.signature(plan_shingles(planner_output)), threshold)
+
+    def similar_code(self, codebase_path: str | Path, threshold: float) -> list[tuple[str, float]]:
+        """Indexed codebases whose source is at least threshold-similar, most similar first."""
+        codebase_path = Path(codebase_path)
+        planner_output_path = codebase_path / "planner_output.json"
+        service_names = (
+            _planned_services(json.loads(planner_output_path.read_text()))
+            if planner_output_path.is_file() else None
+        )
+        matches = self._query(
+            "code", self.signature(code_shingles(codebase_path, service_names)), threshold
+        )
+        return [m for m in matches if m[0] != codebase_path.name]